@@ -5,50 +5,161 @@ server.py
 WebSocket server that:
   • Receives pose data (position + rotation) from WebXR clients
   • Computes velocities between frames
-  • Sends structured JSON updates to any connected viewer clients
-  • Pretty-prints JSON logs in the terminal
+  • Sends structured JSON updates to any connected viewer clients, batched
+    into one JSON array per ~16 ms tick
+  • Pretty-prints JSON logs in the terminal (with VERBOSE=1)
 """
 
 import asyncio
-import json
 import math
+import os
 import time
-from collections import defaultdict
+from typing import Any, Optional
 
+import msgspec
 import websockets
+from websockets.frames import Frame, Opcode
 from websockets.protocol import State
 
+try:
+    import uvloop  # optional: libuv-based event loop with faster socket I/O
+except ImportError:
+    uvloop = None
+
 HOST = "0.0.0.0"
 PORT = 8765
 
-# Last known state per client
-client_last = defaultdict(lambda: None)
+# Pretty-print every update to the terminal (debugging only; costs a reformat)
+VERBOSE = os.environ.get("VERBOSE") == "1"
 
-# Track all connected sockets
-clients = set()
+# Updates arriving within this window go out together as one JSON array
+FLUSH_INTERVAL_S = 0.016
 
+# First item of a JSON object frame: int for bytes (BINARY), str for str (TEXT)
+OBJECT_START = (ord("{"), "{")
 
-async def _safe_send(ws, data: str):
-    """Safely send data to a single websocket client."""
-    try:
-        await ws.send(data)
-    except Exception as e:
-        peer = getattr(ws, "remote_address", ("?", "?"))
-        peer_str = f"{peer[0]}:{peer[1]}" if peer else "unknown"
-        print(f"[{peer_str}] ❗ send error: {e}")
+# Last known state per client: (px, py, pz, ts_seconds)
+client_last = {}
+
+# Connected sockets -> outbound queue holding at most the newest (payload, frame)
+clients = {}
+
+# Updates waiting for the next flush
+pending = []
+
+
+# Wire schema: inbound frames decode straight into these structs (no dicts,
+# no per-field float()/isinstance checks); outbound updates encode from them.
+class Vec3(msgspec.Struct):
+    x: float
+    y: float
+    z: float
+
+
+class Quat(msgspec.Struct):
+    x: float
+    y: float
+    z: float
+    w: float
+
+
+class Velocity(msgspec.Struct):
+    vx: float
+    vy: float
+    vz: float
+    speed_m_s: float
+    dt: float
+
+
+class Pose(msgspec.Struct):
+    """Pose frame sent by pose_ar.html. ts is Date.now() (epoch milliseconds)."""
+
+    position: Vec3
+    rotation: Quat
+    # Loosely typed: a quirky ts or clientId must not drop the whole pose
+    clientId: Any = "unknown"
+    ts: Any = None
+
+
+class Update(msgspec.Struct, omit_defaults=True):
+    """Update broadcast to viewers; velocity is omitted on a client's first frame."""
+
+    clientId: Any
+    ts: float
+    position: Vec3
+    rotation: Quat
+    velocity: Optional[Velocity] = None
+
+
+# Shared codec instances, built once at import instead of per
+# msgspec.json.encode / msgspec.json.decode(..., type=Pose) call
+_ENC = msgspec.json.Encoder()
+_DEC = msgspec.json.Decoder(Pose)
 
+# Compact JSON bytes for the wire
+_encode = _ENC.encode
 
-async def broadcast_json(update: dict):
-    """Serialize update and send to all currently open clients."""
-    update_str = json.dumps(update, indent=2)  # ✅ pretty-print JSON
-    print(update_str)  # show JSON in terminal
 
-    active = [c for c in clients if c.state == State.OPEN]
-    if not active:
-        return
+def _pretty(payload: bytes) -> str:
+    """Indented JSON for the terminal log."""
+    return msgspec.json.format(payload, indent=2).decode()
 
-    send_tasks = [asyncio.create_task(_safe_send(c, update_str)) for c in active]
-    await asyncio.gather(*send_tasks)
+
+async def _writer(ws, queue: asyncio.Queue):
+    """Write queued frames to one client for the life of its connection.
+
+    Frames go straight to the transport, bypassing ws.send, so flow control
+    happens here: after each write, wait for the peer to drain while newer
+    frames replace the queued one.
+    """
+    transport = ws.transport
+    # Connection.drain() is undocumented websockets API (checked on websockets
+    # 17.2); without it, fall back to ws.send and its own flow control.
+    drain = getattr(ws, "drain", None)
+    while True:
+        payload, frame = await queue.get()
+        if ws.state is not State.OPEN:
+            return  # closing; the handler's finally block drops it from `clients`
+        try:
+            if drain is None:
+                await ws.send(payload, text=True)
+                continue
+            transport.write(frame)
+            await drain()
+        except (OSError, websockets.ConnectionClosed):
+            return  # connection lost; the handler cleans up
+
+
+def broadcast_json(update: Update):
+    """Add update to the current batch; the first update of a batch arms the flush."""
+    pending.append(update)
+    if len(pending) == 1:
+        asyncio.get_running_loop().call_later(FLUSH_INTERVAL_S, _flush_pending)
+
+
+def _flush_pending():
+    batch = pending.copy()
+    pending.clear()
+    broadcast_json_batch(batch)
+
+
+def broadcast_json_batch(batch: list):
+    """Serialize and frame batch once, then queue the same frame for every connected client.
+
+    Each client's queue holds one frame; a slow client has its stale batch
+    replaced instead of holding up the others.
+    """
+    payload = _encode(batch)
+    if VERBOSE:
+        print(_pretty(payload))  # show JSON in terminal
+
+    # Server-to-client frames are unmasked (RFC 6455 §5.1), so the bytes on
+    # the wire are identical for every recipient
+    frame = Frame(Opcode.TEXT, payload).serialize(mask=False)
+    for queue in clients.values():
+        if queue.full():
+            queue.get_nowait()  # drop the pose this client never got to
+        queue.put_nowait((payload, frame))
 
 
 async def handler(websocket):
@@ -57,85 +168,74 @@ async def handler(websocket):
     peer_str = f"{peer[0]}:{peer[1]}" if peer else "unknown"
     print(f"➡️  Client connected: {peer_str}")
 
-    clients.add(websocket)
+    queue = asyncio.Queue(maxsize=1)
+    clients[websocket] = queue
+    writer = asyncio.create_task(_writer(websocket, queue))
+
+    # A sender's clientId is fixed for the life of its page, so read it once
+    client_id = None
+
+    # Per-frame globals bound as locals (LOAD_FAST instead of LOAD_GLOBAL + attrs)
+    decode = _DEC.decode
+    sqrt = math.sqrt
+    clock = time.time
+    object_start = OBJECT_START
+    last_poses = client_last
+    enqueue = broadcast_json
 
     try:
         async for message in websocket:
-            now = time.time()
+            # Cheap reject of empties/pings/noise before invoking the parser
+            if not message or message[0] not in object_start:
+                continue
 
-            # Parse JSON
+            # Parse + validate: bytes for BINARY frames (pose_ar.html), str for TEXT
             try:
-                data = json.loads(message)
-            except Exception as e:
-                print(f"[{peer_str}] 🔴 Invalid JSON: {e}")
-                continue
-            if not isinstance(data, dict):
+                pose = decode(message)
+            except (msgspec.DecodeError, UnicodeDecodeError) as e:
+                # BINARY frames skip the WebSocket UTF-8 check, so bad bytes surface here
+                print(f"[{peer_str}] 🔴 Invalid pose: {e}")
                 continue
 
-            client_id = data.get("clientId", "unknown")
-            ts = data.get("ts")
-            if isinstance(ts, (int, float)):
-                ts_s = ts / 1000.0 if ts > 1e12 else ts
-            else:
-                ts_s = now
+            ts = pose.ts
+            ts_s = ts / 1000.0 if type(ts) in (int, float) else clock()
 
-            pos = data.get("position")
-            rot = data.get("rotation")
-            if not pos or not rot:
-                continue
+            pos = pose.position
+            px, py, pz = pos.x, pos.y, pos.z
 
-            try:
-                px, py, pz = float(pos["x"]), float(pos["y"]), float(pos["z"])
-                rx, ry, rz, rw = (
-                    float(rot["x"]),
-                    float(rot["y"]),
-                    float(rot["z"]),
-                    float(rot["w"]),
-                )
-            except Exception:
-                continue
+            if client_id is None:
+                client_id = pose.clientId
 
             # Compute velocity
             vel_info = None
-            last = client_last[websocket]
-            if last and isinstance(last.get("pos"), dict) and isinstance(
-                last.get("ts"), (int, float)
-            ):
-                dt = ts_s - last["ts"] if ts_s >= last["ts"] else (now - last["ts"])
+            last = last_poses.get(websocket)
+            if last is not None:
+                lpx, lpy, lpz, lts = last
+                # Server clock only when the client's ts went backwards
+                dt = ts_s - lts if ts_s >= lts else (clock() - lts)
                 if dt > 0:
-                    dx = px - last["pos"]["x"]
-                    dy = py - last["pos"]["y"]
-                    dz = pz - last["pos"]["z"]
-                    speed = math.sqrt(dx * dx + dy * dy + dz * dz) / dt
-                    vel_info = {
-                        "vx": dx / dt,
-                        "vy": dy / dt,
-                        "vz": dz / dt,
-                        "speed_m_s": speed,
-                        "dt": dt,
-                    }
+                    dx = px - lpx
+                    dy = py - lpy
+                    dz = pz - lpz
+                    inv_dt = 1.0 / dt  # one division, then four multiplies
+                    speed = sqrt(dx * dx + dy * dy + dz * dz) * inv_dt
+                    vel_info = Velocity(dx * inv_dt, dy * inv_dt, dz * inv_dt, speed, dt)
 
             # Save last pose
-            client_last[websocket] = {"pos": {"x": px, "y": py, "z": pz}, "ts": ts_s}
+            last_poses[websocket] = (px, py, pz, ts_s)
 
-            # Build JSON update
-            update = {
-                "clientId": client_id,
-                "ts": ts_s,
-                "position": {"x": px, "y": py, "z": pz},
-                "rotation": {"x": rx, "y": ry, "z": rz, "w": rw},
-            }
-            if vel_info:
-                update["velocity"] = vel_info
+            # Build update, reusing the decoded position/rotation structs
+            update = Update(client_id, ts_s, pos, pose.rotation, vel_info)
 
-            # Broadcast JSON
-            await broadcast_json(update)
+            # Broadcast JSON (on the next flush)
+            enqueue(update)
 
     except websockets.ConnectionClosed:
         print(f"⬅️  Client disconnected: {peer_str}")
     finally:
+        writer.cancel()
         client_last.pop(websocket, None)
-        clients.discard(websocket)
+        clients.pop(websocket, None)
 
 
 async def main():
@@ -145,7 +245,8 @@ async def main():
 
 
 if __name__ == "__main__":
+    run = uvloop.run if uvloop is not None else asyncio.run
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         print("Shutting down.")
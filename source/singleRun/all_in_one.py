@@ -5,17 +5,21 @@ all_in_one.py
 One-process WebXR pipeline:
   • Serves /pose (WebXR sender) and /viewer (3D viewer) over HTTP/HTTPS
   • WebSocket endpoint at /ws for bidirectional pose updates
-  • Pretty-prints structured JSON, computes velocities between frames
+  • Pretty-prints structured JSON (with --verbose), computes velocities between frames
   • Designed for a SINGLE Cloudflare tunnel or local HTTPS
 
 USAGE
 =====
 1) Install deps:
-   pip install aiohttp
+   pip install aiohttp msgspec
+   pip install uvloop   # optional, faster event loop (Linux/macOS)
 
 2) Start server (HTTP):
    python all_in_one.py --host 0.0.0.0 --port 8765
 
+   (Optional) Log every pose update as pretty JSON:
+   python all_in_one.py --verbose
+
    (Optional) Local HTTPS with your own cert:
    python all_in_one.py --host 0.0.0.0 --port 8765 \
      --certfile /path/to/cert.pem --keyfile /path/to/key.pem
@@ -40,33 +44,96 @@ from __future__ import annotations
 
 import argparse
 import asyncio
-import json
 import math
 import os
 import signal
 import ssl
+import struct
 import sys
 import time
-from collections import defaultdict
-from typing import Dict, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
+import msgspec
 from aiohttp import web, WSMsgType
 
+try:
+    import uvloop  # optional: libuv-based event loop with faster socket I/O
+except ImportError:
+    uvloop = None
+
 # -----------------------------
 # Config (defaults; can override via CLI)
 # -----------------------------
 DEFAULT_HOST = os.environ.get("HOST", "0.0.0.0")
 DEFAULT_PORT = int(os.environ.get("PORT", 8765))
 
+# Pretty-print every update to the terminal (set by --verbose)
+VERBOSE = False
+
+# Updates arriving within this window go out together as one JSON array
+FLUSH_INTERVAL_S = 0.016
+
+# First item of a JSON object frame: int for bytes (BINARY), str for str (TEXT)
+OBJECT_START = (ord("{"), "{")
+
+# -----------------------------
+# Wire schema (msgspec)
+# -----------------------------
+# Inbound frames decode straight into these structs (no dicts, no per-field
+# float()/isinstance checks); outbound updates encode from them.
+class Vec3(msgspec.Struct):
+    x: float
+    y: float
+    z: float
+
+
+class Quat(msgspec.Struct):
+    x: float
+    y: float
+    z: float
+    w: float
+
+
+class Velocity(msgspec.Struct):
+    vx: float
+    vy: float
+    vz: float
+    speed_m_s: float
+    dt: float
+
+
+class Pose(msgspec.Struct):
+    """Pose frame sent by /pose. ts is Date.now() (epoch milliseconds)."""
+
+    position: Vec3
+    rotation: Quat
+    # Loosely typed: a quirky ts or clientId must not drop the whole pose
+    clientId: Any = "unknown"
+    ts: Any = None
+
+
+class Update(msgspec.Struct, omit_defaults=True):
+    """Update broadcast to viewers; velocity is omitted on a client's first frame."""
+
+    clientId: Any
+    ts: float
+    position: Vec3
+    rotation: Quat
+    velocity: Optional[Velocity] = None
+
+
 # -----------------------------
 # In-memory state
 # -----------------------------
-# Track all connected WS clients
-WSClients = set()
+# Track all connected WS clients -> outbound queue holding at most the newest (payload, frame)
+WSClients: Dict[web.WebSocketResponse, asyncio.Queue] = {}
 
-# Last known (per-connection) pose for velocity estimation
+# Updates waiting for the next flush
+pending: List[Update] = []
+
+# Last known (per-connection) pose for velocity estimation: (px, py, pz, ts_seconds)
 # Keyed by the aiohttp WebSocketResponse object
-client_last: Dict[web.WebSocketResponse, Optional[dict]] = defaultdict(lambda: None)
+client_last: Dict[web.WebSocketResponse, Tuple[float, float, float, float]] = {}
 
 
 # -----------------------------
@@ -77,51 +144,118 @@ def now_s() -> float:
     return time.time()
 
 
-def pretty(obj) -> str:
-    return json.dumps(obj, indent=2, ensure_ascii=False)
+# Shared codec instances, built once at import instead of per
+# msgspec.json.encode / msgspec.json.decode(..., type=Pose) call
+_ENC = msgspec.json.Encoder()
+_DEC = msgspec.json.Decoder(Pose)
 
+# Compact JSON bytes for the wire
+encode = _ENC.encode
 
-async def _safe_send(ws: web.WebSocketResponse, data: dict) -> None:
-    """Send a JSON object safely to a single client."""
-    if ws.closed:
-        return
-    try:
-        await ws.send_str(pretty(data))
-    except Exception as e:
-        peer = ws.headers.get("X-Forwarded-For") or str(ws._req.remote) if hasattr(ws, "_req") else "unknown"
-        print(f"[{peer}] ❗ send error: {e}")
+
+def pretty(payload: bytes) -> str:
+    """Indented JSON for the terminal log."""
+    return msgspec.json.format(payload, indent=2).decode()
 
 
-async def broadcast(update: dict) -> None:
-    """Broadcast pretty JSON to all open clients."""
-    # Log once to terminal (pretty)
-    print(pretty(update))
-    if not WSClients:
-        return
-    await asyncio.gather(*(_safe_send(ws, update) for ws in list(WSClients) if not ws.closed))
+def text_frame(payload: bytes) -> bytes:
+    """
+    Wrap payload in a single unmasked TEXT frame (RFC 6455 §5.2).
+    Server-to-client frames are never masked, so one frame serves every recipient.
+    """
+    n = len(payload)
+    if n < 126:
+        header = struct.pack("!BB", 0x81, n)
+    elif n < 1 << 16:
+        header = struct.pack("!BBH", 0x81, 126, n)
+    else:
+        header = struct.pack("!BBQ", 0x81, 127, n)
+    return header + payload
 
 
-def compute_velocity(last: dict, px: float, py: float, pz: float, ts_s: float, fallback_now: float) -> Optional[dict]:
+async def _writer(ws: web.WebSocketResponse, request: web.Request, queue: asyncio.Queue) -> None:
+    """
+    Write queued frames to one client for the life of its connection.
+    Frames go straight to the transport, bypassing ws.send_*, so flow control
+    happens here: after each write, wait for the peer to drain while newer
+    frames replace the queued one.
+    """
+    transport = request.transport
+    protocol = request.protocol
+    # BaseProtocol.writing_paused/_drain_helper() are aiohttp internals (checked on
+    # aiohttp 3.14.5); without them, fall back to ws.send_frame and its own flow control.
+    drain = getattr(protocol, "_drain_helper", None)
+    if not hasattr(protocol, "writing_paused"):
+        drain = None
+    while True:
+        payload, frame = await queue.get()
+        if ws.closed or transport is None or transport.is_closing():
+            return  # closing; handle_ws's finally block drops it from WSClients
+        try:
+            if drain is None:
+                await ws.send_frame(payload, WSMsgType.TEXT)
+                continue
+            transport.write(frame)
+            if protocol.writing_paused:
+                await drain()
+        except OSError:
+            return  # connection lost; handle_ws cleans up
+
+
+def broadcast(update: Update) -> None:
+    """Add update to the current batch; the first update of a batch arms the flush."""
+    pending.append(update)
+    if len(pending) == 1:
+        asyncio.get_running_loop().call_later(FLUSH_INTERVAL_S, _flush_pending)
+
+
+def _flush_pending() -> None:
+    batch = pending.copy()
+    pending.clear()
+    broadcast_batch(batch)
+
+
+def broadcast_batch(batch: List[Update]) -> None:
+    """Queue one compact JSON array for all open clients, keeping only the newest per client."""
+    # Encode and frame once for every recipient; the pretty log is opt-in
+    payload = encode(batch)
+    if VERBOSE:
+        print(pretty(payload))
+    frame = text_frame(payload)
+    # A slow client has its stale batch replaced instead of blocking everyone else
+    for queue in WSClients.values():
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait((payload, frame))
+
+
+def compute_velocity(
+    last: Optional[Tuple[float, float, float, float]],
+    px: float,
+    py: float,
+    pz: float,
+    ts_s: float,
+    fallback_now_fn: Callable[[], float] = now_s,
+) -> Optional[Velocity]:
     """
     Compute velocity from last pose. Use client timestamp if monotonic, else fallback to server delta.
-    last = {"pos": {"x":..., "y":..., "z":...}, "ts": <seconds>}
+    last = (px, py, pz, ts_seconds); fallback_now_fn is only called on the fallback path.
     """
-    if not last or not isinstance(last.get("pos"), dict):
-        return None
-    last_ts = last.get("ts")
-    if not isinstance(last_ts, (int, float)):
+    if last is None:
         return None
+    last_px, last_py, last_pz, last_ts = last
 
     # Prefer client dt if non-negative; otherwise use server delta to avoid negative time differences
-    dt = ts_s - last_ts if ts_s >= last_ts else (fallback_now - last_ts)
+    dt = ts_s - last_ts if ts_s >= last_ts else (fallback_now_fn() - last_ts)
     if dt <= 0:
         return None
 
-    dx = px - last["pos"]["x"]
-    dy = py - last["pos"]["y"]
-    dz = pz - last["pos"]["z"]
-    speed = math.sqrt(dx * dx + dy * dy + dz * dz) / dt
-    return {"vx": dx / dt, "vy": dy / dt, "vz": dz / dt, "speed_m_s": speed, "dt": dt}
+    dx = px - last_px
+    dy = py - last_py
+    dz = pz - last_pz
+    inv_dt = 1.0 / dt  # one division, then four multiplies
+    speed = math.sqrt(dx * dx + dy * dy + dz * dz) * inv_dt
+    return Velocity(dx * inv_dt, dy * inv_dt, dz * inv_dt, speed, dt)
 
 
 # -----------------------------
@@ -271,6 +405,10 @@ POSE_HTML = """<!doctype html>
   const CLIENT_ID = Math.random().toString(36).substring(2, 9);
   const MAX_HZ = 30;
 
+  // Poses go out as BINARY frames (UTF-8 JSON) so the server skips a
+  // redundant UTF-8 validation pass before parsing.
+  const encoder = new TextEncoder();
+
   const startButton = document.getElementById("startButton");
   const statusText = document.getElementById("statusText");
   
@@ -331,13 +469,13 @@ POSE_HTML = """<!doctype html>
 
     const msg = {
       clientId: CLIENT_ID,
-      ts: Date.now(),
+      ts: Date.now(), // epoch milliseconds; the server requires ms
       position: { x: t.position.x, y: t.position.y, z: t.position.z + 1.0},
       rotation: { x: t.orientation.x, y: t.orientation.y, z: t.orientation.z, w: t.orientation.w },
     };
     
     try { 
-      socket.send(JSON.stringify(msg)); 
+      socket.send(encoder.encode(JSON.stringify(msg))); 
       lastSend = now; 
     } catch (e) {
       console.warn("Failed to send pose:", e);
@@ -540,9 +678,12 @@ VIEWER_HTML = """<!doctype html>
       };
       ws.onmessage = (event) => {
         try {
+          // Server sends one JSON array of updates per tick
           const data = JSON.parse(event.data);
-          if (data.position && data.rotation) {
-            latestPose = data;
+          for (const update of Array.isArray(data) ? data : [data]) {
+            if (update.position && update.rotation) {
+              latestPose = update;
+            }
           }
         } catch (e) {
           // Ignore non-JSON messages
@@ -628,68 +769,67 @@ async def handle_ws(request: web.Request) -> web.WebSocketResponse:
     await ws.prepare(request)
     ws._req = request  # (for logging peer)
 
-    WSClients.add(ws)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+    WSClients[ws] = queue
+    writer = asyncio.create_task(_writer(ws, request, queue))
     peer = request.headers.get("X-Forwarded-For") or request.remote or "unknown"
     print(f"➡️  WS connected: {peer} (total={len(WSClients)})")
 
+    # A sender's clientId is fixed for the life of its page, so read it once
+    client_id = None
+
+    # Per-frame globals bound as locals (LOAD_FAST instead of LOAD_GLOBAL + attrs)
+    decode = _DEC.decode
+    velocity = compute_velocity
+    object_start = OBJECT_START
+    last_poses = client_last
+    enqueue = broadcast
+
     try:
         async for msg in ws:
-            if msg.type == WSMsgType.TEXT:
-                # Messages may be pretty JSON strings; parse & validate
+            if msg.type == WSMsgType.BINARY or msg.type == WSMsgType.TEXT:
+                # /pose sends UTF-8 JSON as BINARY (no text-frame UTF-8 check);
+                # TEXT is still accepted from other clients. Parse & validate
+                raw = msg.data
+                if not raw or raw[0] not in object_start:
+                    continue  # cheap reject of empties/noise before the parser
                 try:
-                    data = json.loads(msg.data)
-                except Exception as e:
-                    print(f"[{peer}] 🔴 Invalid JSON: {e}")
+                    pose = decode(raw)
+                except (msgspec.DecodeError, UnicodeDecodeError) as e:
+                    # BINARY frames skip the WebSocket UTF-8 check, so bad bytes surface here
+                    print(f"[{peer}] 🔴 Invalid pose: {e}")
                     continue
 
-                if not isinstance(data, dict):
-                    continue
+                # Normalize timestamp. Contract: senders put Date.now() (epoch ms) in ts
+                raw_ts = pose.ts
+                ts_s = raw_ts / 1000.0 if type(raw_ts) in (int, float) else now_s()
 
-                # Normalize timestamp
-                raw_ts = data.get("ts")
-                if isinstance(raw_ts, (int, float)):
-                    # If looks like ms epoch (>= 1e12), convert to seconds
-                    ts_s = raw_ts / 1000.0 if raw_ts > 1e12 else float(raw_ts)
-                else:
-                    ts_s = now_s()
-
-                pos = data.get("position")
-                rot = data.get("rotation")
-                if not (isinstance(pos, dict) and isinstance(rot, dict)):
-                    continue
-
-                try:
-                    px, py, pz = float(pos["x"]), float(pos["y"]), float(pos["z"])
-                    rx, ry, rz, rw = float(rot["x"]), float(rot["y"]), float(rot["z"]), float(rot["w"])
-                except Exception:
-                    continue
+                pos = pose.position
+                px, py, pz = pos.x, pos.y, pos.z
 
                 # Velocity
-                vel_info = compute_velocity(client_last.get(ws), px, py, pz, ts_s, fallback_now=now_s())
+                vel_info = velocity(last_poses.get(ws), px, py, pz, ts_s)
 
                 # Save last pose for this connection
-                client_last[ws] = {"pos": {"x": px, "y": py, "z": pz}, "ts": ts_s}
+                last_poses[ws] = (px, py, pz, ts_s)
+
+                if client_id is None:
+                    client_id = pose.clientId
 
-                # Build update
-                update = {
-                    "clientId": data.get("clientId", "unknown"),
-                    "ts": ts_s,
-                    "position": {"x": px, "y": py, "z": pz},
-                    "rotation": {"x": rx, "y": ry, "z": rz, "w": rw},
-                }
-                if vel_info:
-                    update["velocity"] = vel_info
+                # Build update, reusing the decoded position/rotation structs
+                update = Update(client_id, ts_s, pos, pose.rotation, vel_info)
 
-                # Broadcast to all clients (including sender; viewer ignores if desired)
-                await broadcast(update)
+                # Broadcast to all clients on the next flush (including sender; viewer ignores if desired)
+                enqueue(update)
 
             elif msg.type == WSMsgType.ERROR:
                 print(f"[{peer}] WS error: {ws.exception()}")
 
     finally:
         # Cleanup
+        writer.cancel()
         client_last.pop(ws, None)
-        WSClients.discard(ws)
+        WSClients.pop(ws, None)
         print(f"⬅️  WS disconnected: {peer} (total={len(WSClients)})")
 
     return ws
@@ -756,14 +896,18 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
     p.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Bind port (default: {DEFAULT_PORT})")
     p.add_argument("--certfile", help="Path to TLS cert (PEM). Enables HTTPS if provided with --keyfile.")
     p.add_argument("--keyfile", help="Path to TLS key (PEM). Enables HTTPS if provided with --certfile.")
+    p.add_argument("--verbose", action="store_true", help="Pretty-print every pose update to the terminal.")
     return p.parse_args(argv)
 
 
 def main(argv: list[str]) -> int:
+    global VERBOSE
     args = parse_args(argv)
+    VERBOSE = args.verbose
     ssl_ctx = make_ssl_context(args.certfile, args.keyfile)
+    run = uvloop.run if uvloop is not None else asyncio.run
     try:
-        asyncio.run(start_server(args.host, args.port, ssl_ctx))
+        run(start_server(args.host, args.port, ssl_ctx))
         return 0
     except KeyboardInterrupt:
         print("Shutting down.")